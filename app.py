@@ -1,4 +1,6 @@
+import hashlib
 import os
+import time
 from http import HTTPStatus
 
 import datetime
@@ -7,25 +9,51 @@ import tornado.options
 import tornado.httpserver
 import tornado.ioloop
 import tornado.escape
-from sqlalchemy import create_engine, or_, and_
+import tornado.gen
+from sqlalchemy import create_engine, and_, exists
 from sqlalchemy.orm import sessionmaker
-from passlib.hash import pbkdf2_sha256
 
-from database import Client, FirstName, LastName, Rent, HotelNumber, User
-from tools import get_first_name_id, get_last_name_id, serialize
+from archive import RentArchiver
+from database import Client, FirstName, LastName, Rent, ArchivedRent, HotelNumber, User, ClientChange
+from idempotency import IdempotencyStore, StoredResponse
+from migrations import upgrade_schema
+from search import ClientSearchIndex
+from throttling import RateLimiter, LoadShedder, LoopLagMonitor, Priority, format_retry_after
+from tools import get_first_name_id, get_last_name_id, serialize, NameDictionary
 
 DATE_FORMAT = "%Y-%m-%d"
 
 tornado.options.define('port', default=8888, help='Run on the given port', type=int)
 tornado.options.define('database_connection_string', default='sqlite:///hotel.db', help='Select database', type=str)
+tornado.options.define('rate_limit', default=100, help='Requests per second allowed for each user (0 - unlimited)',
+                       type=float)
+tornado.options.define('rate_limit_burst', default=500, help='Requests each user can make at once', type=int)
+tornado.options.define('max_queue_delay', default=0.5,
+                       help='IOLoop lag in seconds after which bulk reads are shed (0 - never shed)', type=float)
+tornado.options.define('loop_lag_check_interval', default=0.1, help='Seconds between checks of IOLoop lag', type=float)
+tornado.options.define('archive_retention_days', default=365,
+                       help='Days after end of rent before it is moved to archive (0 - never archive)', type=int)
+tornado.options.define('archive_batch_size', default=500, help='Rents moved to archive in one transaction', type=int)
+tornado.options.define('archive_interval', default=600, help='Seconds between archivation runs', type=int)
+tornado.options.define('client_index_sync_interval', default=1.0,
+                       help='Seconds between updates of client search index with changes of other workers', type=float)
+tornado.options.define('hotel_numbers_cache_ttl', default=5.0,
+                       help='Seconds list of hotel numbers is cached, changes of other workers are seen after it',
+                       type=float)
+tornado.options.define('idempotency_ttl', default=24 * 60 * 60,
+                       help='Seconds response to request with Idempotency-Key is kept for replay', type=int)
+tornado.options.define('idempotency_max_keys', default=10000, help='Max number of kept Idempotency-Key responses',
+                       type=int)
 
 
 class Application(tornado.web.Application):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, database_connection_string=None, **kwargs):
         handlers = [
             (r"/login", LoginHandler),
             (r"/logout", LogoutHandler),
+            (r"/ready", ReadyHandler),
             (r"/client", ClientHandler),
+            (r"/client/search", ClientSearchHandler),
             (r"/rent", RentHandler),
             (r"/number", NumbersHandler),
         ]
@@ -37,15 +65,189 @@ class Application(tornado.web.Application):
         )
         tornado.web.Application.__init__(self, handlers, *args, **{**kwargs, **settings})
 
-        self.db_engine = create_engine(tornado.options.options.database_connection_string)
+        self.db_engine = create_engine(database_connection_string or
+                                       tornado.options.options.database_connection_string)
         self.db_session_maker = sessionmaker(bind=self.db_engine)
         self.db_session = self.db_session_maker()
 
+        self.ready = False
+        self.client_search_index = ClientSearchIndex()
+        self.first_names = NameDictionary(get_first_name_id, FirstName.first_name, FirstName.id)
+        self.last_names = NameDictionary(get_last_name_id, LastName.last_name, LastName.id)
+        self.hotel_numbers = None
+        self.hotel_numbers_expire_at = 0.0
+
+        self.user_rate_limiter = RateLimiter(tornado.options.options.rate_limit,
+                                             tornado.options.options.rate_limit_burst)
+        self.route_rate_limiters = {}
+        self.load_shedder = LoadShedder(tornado.options.options.max_queue_delay)
+        self.loop_lag_monitor = LoopLagMonitor(tornado.options.options.loop_lag_check_interval)
+
+        self.rent_archiver = RentArchiver(self.db_session_maker,
+                                          tornado.options.options.archive_retention_days,
+                                          tornado.options.options.archive_batch_size)
+
+        self.idempotency_store = IdempotencyStore(tornado.options.options.idempotency_ttl,
+                                                  tornado.options.options.idempotency_max_keys)
+
+    def warm_up(self):
+        """Bring schema up to date and fill small caches, so first requests are served at full speed.
+
+        The client search index is too big to be loaded before listening, it is loaded by ``load_search_index``.
+        """
+        upgrade_schema(self.db_engine)
+
+        self.db_session.execute('SELECT 1')
+        self.first_names.load(self.db_session)
+        self.last_names.load(self.db_session)
+        self.get_hotel_numbers()
+        self.db_session.commit()
+
+    @tornado.gen.coroutine
+    def load_search_index(self):
+        """Load the client search index chunk by chunk, serving requests in between, then become ready."""
+        session = self.db_session_maker()
+        try:
+            for _ in self.client_search_index.iter_load(session):
+                yield tornado.gen.moment
+        finally:
+            session.close()
+        self.ready = True
+
+    def start(self):
+        """Start background tasks on the current IOLoop."""
+        self.loop_lag_monitor.start()
+        tornado.ioloop.IOLoop.current().add_callback(self.load_search_index)
+        tornado.ioloop.PeriodicCallback(self.rent_archiver.run,
+                                        tornado.options.options.archive_interval * 1000).start()
+        tornado.ioloop.PeriodicCallback(self.sync_client_search_index,
+                                        tornado.options.options.client_index_sync_interval * 1000).start()
+
+    def sync_client_search_index(self):
+        session = self.db_session_maker()
+        try:
+            self.client_search_index.sync(session)
+        finally:
+            session.close()
+
+    def get_hotel_numbers(self):
+        if self.hotel_numbers is None or time.monotonic() >= self.hotel_numbers_expire_at:
+            self.hotel_numbers = self.db_session.query(*NumbersHandler.make_keys(Rent, None)).all()
+            self.hotel_numbers_expire_at = time.monotonic() + tornado.options.options.hotel_numbers_cache_ttl
+        return self.hotel_numbers
+
 
 class BaseHandler(tornado.web.RequestHandler):
+    # (requests per second, burst) allowed for each user on this route, None - only global user limit
+    RATE_LIMIT = None
+    HISTORY_ARGUMENT = 'history'
+    # writes of handlers with IDEMPOTENT set honour Idempotency-Key header; login and logout must not be
+    # replayed: the replay would neither set nor clear the cookie
+    IDEMPOTENT = False
+    IDEMPOTENCY_HEADER = 'Idempotency-Key'
+    WRITE_METHODS = ('POST', 'PUT', 'DELETE')
+
     def __init__(self, application, request, **kwargs):
         super().__init__(application, request, **kwargs)
         self.db_session = self.application.db_session
+        self._idempotency_key = None
+        self._response_chunks = []
+
+    def prepare(self):
+        retry_after = self.application.load_shedder.retry_after(self.get_priority(),
+                                                                self.application.loop_lag_monitor.lag)
+        if retry_after:
+            self.reject(HTTPStatus.SERVICE_UNAVAILABLE, retry_after)
+            return
+
+        retry_after = self.get_rate_limit_delay()
+        if retry_after:
+            self.reject(HTTPStatus.TOO_MANY_REQUESTS, retry_after)
+            return
+
+        return self.check_idempotency_key()
+
+    def get_priority(self):
+        if self.request.method != 'GET':
+            return Priority.WRITE
+        if self.request.arguments:
+            return Priority.READ
+        return Priority.BULK_READ
+
+    def get_rate_limit_delay(self):
+        user_key = self.current_user or self.request.remote_ip
+
+        if self.application.user_rate_limiter.rate:
+            retry_after = self.application.user_rate_limiter.consume(user_key)
+            if retry_after:
+                return retry_after
+
+        if self.RATE_LIMIT:
+            route_rate_limiter = self.application.route_rate_limiters.get(self.__class__)
+            if route_rate_limiter is None:
+                route_rate_limiter = self.application.route_rate_limiters[self.__class__] = \
+                    RateLimiter(*self.RATE_LIMIT)
+            return route_rate_limiter.consume(user_key)
+        return 0
+
+    def reject(self, status, retry_after):
+        self.set_status(status)
+        self.set_header('Retry-After', format_retry_after(retry_after))
+        self.finish()
+
+    def check_idempotency_key(self):
+        key = self.request.headers.get(self.IDEMPOTENCY_HEADER)
+        if not self.IDEMPOTENT or not key or self.request.method not in self.WRITE_METHODS:
+            return None
+
+        scoped_key = (self.current_user, self.request.method, self.request.path, key)
+        stored = self.application.idempotency_store.get(scoped_key)
+        if stored is None:
+            self._idempotency_key = scoped_key
+            self.application.idempotency_store.begin(scoped_key)
+        elif isinstance(stored, StoredResponse):
+            if stored.fingerprint != self.get_request_fingerprint():
+                # same key reused for another request: its stored response would be a lie
+                raise tornado.web.HTTPError(HTTPStatus.UNPROCESSABLE_ENTITY,
+                                            reason='Idempotency-Key was used with other parameters')
+            self.replay(stored)
+        else:
+            return self.wait_for_duplicate(stored)
+
+    @tornado.gen.coroutine
+    def wait_for_duplicate(self, future):
+        yield future
+        waiting = self.check_idempotency_key()
+        if waiting is not None:
+            yield waiting
+
+    def get_request_fingerprint(self):
+        return hashlib.sha256(self.request.query.encode() + b'?' + self.request.body).hexdigest()
+
+    def replay(self, response):
+        self.set_status(response.status)
+        if response.content_type:
+            self.set_header('Content-Type', response.content_type)
+        self.set_header('Idempotent-Replayed', 'true')
+        for chunk in response.chunks:
+            self.write(chunk)
+        self.finish()
+
+    def write(self, chunk):
+        super().write(chunk)
+        if self._idempotency_key:
+            self._response_chunks.append(chunk)
+
+    def on_finish(self):
+        if self._idempotency_key:
+            response = None
+            if self.get_status() < HTTPStatus.MULTIPLE_CHOICES:
+                response = StoredResponse(self.get_status(), self._headers.get('Content-Type'), self._response_chunks,
+                                          self.get_request_fingerprint())
+            self.application.idempotency_store.complete(self._idempotency_key, response)
+
+    def include_history(self):
+        return self.get_argument(self.HISTORY_ARGUMENT, '').lower() in ('1', 'true', 'yes')
 
     def data_received(self, chunk):
         return super().data_received(chunk)
@@ -73,6 +275,7 @@ class LoginHandler(BaseHandler):
     def check_permission(self, username, password):
         rows = self.db_session.query(User.password_hash).filter(User.name == username).first()
         if rows:
+            from passlib.hash import pbkdf2_sha256
             return pbkdf2_sha256.verify(password, rows[0])
         else:
             return False
@@ -89,7 +292,20 @@ class LogoutHandler(BaseHandler):
         self.clear_cookie('user')
 
 
+class ReadyHandler(BaseHandler):
+    def prepare(self):
+        # readiness probes are never throttled
+        pass
+
+    def get(self):
+        if not self.application.ready:
+            raise tornado.web.HTTPError(HTTPStatus.SERVICE_UNAVAILABLE)
+        self.write('ready')
+
+
 class ClientHandler(BaseHandler):
+    RATE_LIMIT = (20, 100)
+    IDEMPOTENT = True
     ID_ARGUMENT = 'id'
 
     @tornado.web.authenticated
@@ -109,50 +325,122 @@ class ClientHandler(BaseHandler):
 
     @tornado.web.authenticated
     def post(self):
-        self.db_session.add(
-            Client(
-                first_name_id=get_first_name_id(self.db_session, self.get_argument('first_name')),
-                last_name_id=get_last_name_id(self.db_session, self.get_argument('last_name')),
-                age=self.get_argument('age'),
-                passport_serial=self.get_argument('passport_serial'),
-                passport_number=self.get_argument('passport_number'),
-            )
+        client = Client(
+            first_name_id=self.application.first_names.get_id(self.db_session, self.get_argument('first_name')),
+            last_name_id=self.application.last_names.get_id(self.db_session, self.get_argument('last_name')),
+            age=self.get_argument('age'),
+            passport_serial=self.get_argument('passport_serial'),
+            passport_number=self.get_argument('passport_number'),
         )
+        self.db_session.add(client)
+        self.db_session.flush()
+        self.db_session.add(ClientChange(client_id=client.id))
         self.db_session.commit()
 
+        self.application.client_search_index.add(client.id, self.get_argument('first_name'),
+                                                 self.get_argument('last_name'),
+                                                 self.get_argument('passport_serial'),
+                                                 self.get_argument('passport_number'))
+
     @tornado.web.authenticated
     def delete(self):
-        client_id = self.get_argument(self.ID_ARGUMENT)
-        self.db_session.query(Client).filter(Client.id == client_id).delete()
+        client_id = self._get_client_id()
+        if self.db_session.query(Client).filter(Client.id == client_id).delete():
+            self.db_session.add(ClientChange(client_id=client_id))
         self.db_session.commit()
 
+        self.application.client_search_index.remove(client_id)
+
     @tornado.web.authenticated
     def put(self, client_id=None):
-        client_id = self.get_argument(self.ID_ARGUMENT)
+        client_id = self._get_client_id()
 
-        self.db_session.query(Client).filter(Client.id == client_id).update({
-            Client.first_name_id: get_first_name_id(self.db_session, self.get_argument('first_name')),
-            Client.last_name_id: get_last_name_id(self.db_session, self.get_argument('last_name')),
+        updated_count = self.db_session.query(Client).filter(Client.id == client_id).update({
+            Client.first_name_id: self.application.first_names.get_id(self.db_session, self.get_argument('first_name')),
+            Client.last_name_id: self.application.last_names.get_id(self.db_session, self.get_argument('last_name')),
             Client.age: self.get_argument('age'),
             Client.passport_serial: self.get_argument('passport_serial'),
             Client.passport_number: self.get_argument('passport_number'),
         })
+        if updated_count == 1:
+            self.db_session.add(ClientChange(client_id=client_id))
         self.db_session.commit()
 
+        if updated_count == 1:
+            self.application.client_search_index.add(client_id, self.get_argument('first_name'),
+                                                     self.get_argument('last_name'),
+                                                     self.get_argument('passport_serial'),
+                                                     self.get_argument('passport_number'))
+
+    def _get_client_id(self):
+        try:
+            return int(self.get_argument(self.ID_ARGUMENT))
+        except ValueError:
+            raise tornado.web.HTTPError(HTTPStatus.BAD_REQUEST)
+
+
+class ClientSearchHandler(BaseHandler):
+    QUERY_ARGUMENT = 'q'
+    LIMIT_ARGUMENT = 'limit'
+    DEFAULT_LIMIT = 20
+    MAX_LIMIT = 100
+
+    # the index is loaded after the server starts listening
+    INDEX_LOADING_RETRY_AFTER = 1
+
+    @tornado.web.authenticated
+    def get(self):
+        if not self.application.client_search_index.loaded:
+            self.reject(HTTPStatus.SERVICE_UNAVAILABLE, self.INDEX_LOADING_RETRY_AFTER)
+            return
+
+        search_query = self.get_argument(self.QUERY_ARGUMENT)
+        try:
+            limit = min(int(self.get_argument(self.LIMIT_ARGUMENT, self.DEFAULT_LIMIT)), self.MAX_LIMIT)
+        except ValueError:
+            raise tornado.web.HTTPError(HTTPStatus.BAD_REQUEST)
+
+        client_id_list = self.application.client_search_index.search(search_query, limit)
+
+        keys = (Client.id, FirstName.first_name, LastName.last_name, Client.age,
+                Client.passport_serial, Client.passport_number)
+        rows = []
+        if client_id_list:
+            rows_by_id = {row[0]: row for row in self.db_session
+                          .query(*keys)
+                          .join(FirstName)
+                          .join(LastName)
+                          .filter(Client.id.in_(client_id_list))}
+            rows = [rows_by_id[client_id] for client_id in client_id_list if client_id in rows_by_id]
+
+        self.set_header('Content-Type', 'application/json')
+        self.write(serialize(keys, rows))
+
 
 class RentHandler(BaseHandler):
+    RATE_LIMIT = (20, 100)
+    IDEMPOTENT = True
     ID_ARGUMENT = 'id'
 
     @tornado.web.authenticated
     def get(self):
         rent_id = self.get_argument(self.ID_ARGUMENT, None)
-        keys = (Rent.id, Rent.hotel_number, Rent.from_date, Rent.to_date, Rent.total_price, Client.id)
-        query = self.db_session.query(*keys).join((Client, Rent.clients))
-        if rent_id:
-            query = query.filter(Rent.id == int(rent_id))
+        rent_models = (Rent, ArchivedRent) if self.include_history() else (Rent,)
+
+        rows = []
+        for rent_model in rent_models:
+            query = self.db_session.query(*self.make_keys(rent_model)).join((Client, rent_model.clients))
+            if rent_id:
+                query = query.filter(rent_model.id == int(rent_id))
+            rows += query.all()
 
         self.set_header('Content-Type', 'application/json')
-        self.write(serialize(keys, query.all()))
+        self.write(serialize(self.make_keys(Rent), rows))
+
+    @staticmethod
+    def make_keys(rent_model):
+        return (rent_model.id, rent_model.hotel_number, rent_model.from_date, rent_model.to_date,
+                rent_model.total_price, Client.id)
 
     @tornado.web.authenticated
     def post(self):
@@ -206,6 +494,8 @@ class RentHandler(BaseHandler):
 
 
 class NumbersHandler(BaseHandler):
+    RATE_LIMIT = (20, 100)
+    IDEMPOTENT = True
     NUMBER_ARGUMENT = 'number'
 
     @tornado.web.authenticated
@@ -214,33 +504,57 @@ class NumbersHandler(BaseHandler):
         state = self.get_argument('state', None)
         at_date_str = self.get_argument('date', None)
 
-        keys = [HotelNumber.number, HotelNumber.price_per_night, HotelNumber.description]
-        if state == 'rented':
-            keys += [Rent.id, Rent.from_date, Rent.to_date,
-                     Client.id, FirstName.first_name, LastName.last_name, Client.age]
-
-        query = self.db_session.query(*keys)
-
         if at_date_str:
             at_date = datetime.datetime.strptime(at_date_str, DATE_FORMAT).date()
         else:
             at_date = datetime.datetime.now()
 
+        rent_models = (Rent, ArchivedRent) if state and self.include_history() else (Rent,)
+        if not number and not state:
+            rows = self.application.get_hotel_numbers()
+        elif state == 'free':
+            rows = self._make_free_query(rent_models, number, at_date).all()
+        else:
+            rows = []
+            for rent_model in rent_models:
+                rows += self._make_query(rent_model, number, state, at_date).all()
+
+        self.set_header('Content-Type', 'application/json')
+        self.write(serialize(self.make_keys(Rent, state), rows))
+
+    @staticmethod
+    def make_keys(rent_model, state):
+        keys = [HotelNumber.number, HotelNumber.price_per_night, HotelNumber.description]
+        if state == 'rented':
+            keys += [rent_model.id, rent_model.from_date, rent_model.to_date,
+                     Client.id, FirstName.first_name, LastName.last_name, Client.age]
+        return keys
+
+    def _make_query(self, rent_model, number, state, at_date):
+        query = self.db_session.query(*self.make_keys(rent_model, state))
+
         if state:
-            query = query.join(Rent)
-        if state == 'free':
-            query = query.filter(or_(Rent.from_date > at_date,
-                                     Rent.to_date < at_date))
-        elif state == 'rented':
-            query = query.join((Client, Rent.clients)).join(FirstName).join(LastName) \
-                .filter(and_(Rent.from_date < at_date,
-                             Rent.to_date > at_date))
+            query = query.join(rent_model)
+        if state == 'rented':
+            query = query.join((Client, rent_model.clients)).join(FirstName).join(LastName) \
+                .filter(and_(rent_model.from_date < at_date,
+                             rent_model.to_date > at_date))
 
         if number:
             query = query.filter(HotelNumber.number == int(number))
+        return query
 
-        self.set_header('Content-Type', 'application/json')
-        self.write(serialize(keys, query.all()))
+    def _make_free_query(self, rent_models, number, at_date):
+        # numbers without rent at date, so numbers whose rents were all archived stay free
+        query = self.db_session.query(*self.make_keys(Rent, 'free'))
+        for rent_model in rent_models:
+            query = query.filter(~exists().where(and_(rent_model.hotel_number == HotelNumber.number,
+                                                      rent_model.from_date < at_date,
+                                                      rent_model.to_date > at_date)))
+
+        if number:
+            query = query.filter(HotelNumber.number == int(number))
+        return query
 
     @tornado.web.authenticated
     def post(self):
@@ -252,6 +566,7 @@ class NumbersHandler(BaseHandler):
             )
         )
         self.db_session.commit()
+        self.application.hotel_numbers = None
 
     @tornado.web.authenticated
     def delete(self):
@@ -259,6 +574,7 @@ class NumbersHandler(BaseHandler):
 
         self.db_session.query(HotelNumber).filter(HotelNumber.number == int(number)).delete()
         self.db_session.commit()
+        self.application.hotel_numbers = None
 
     @tornado.web.authenticated
     def put(self):
@@ -270,10 +586,15 @@ class NumbersHandler(BaseHandler):
             HotelNumber.description: self.get_argument('description'),
         })
         self.db_session.commit()
+        self.application.hotel_numbers = None
 
 
 if __name__ == '__main__':
     tornado.options.parse_command_line()
-    http_server = tornado.httpserver.HTTPServer(Application())
+    application = Application()
+    application.warm_up()
+    http_server = tornado.httpserver.HTTPServer(application)
     http_server.listen(tornado.options.options.port)
+    # becomes ready when the search index is loaded
+    application.start()
     tornado.ioloop.IOLoop.instance().start()
@@ -0,0 +1,60 @@
+import datetime
+
+import tornado.ioloop
+from sqlalchemy import select
+
+from database import Rent, ArchivedRent, rent_operations, archived_rent_operations
+
+RENT_COLUMNS = ('id', 'hotel_number', 'total_price', 'from_date', 'to_date')
+
+
+class RentArchiver:
+    """Moves rents finished before the retention horizon from hot tables to archive ones.
+
+    Work is done in batches of ``batch_size`` rents, each batch in its own transaction, and the IOLoop
+    gets control back between batches.
+    """
+
+    def __init__(self, session_maker, retention_days, batch_size):
+        self.session_maker = session_maker
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+
+    @property
+    def horizon(self):
+        return datetime.date.today() - datetime.timedelta(days=self.retention_days)
+
+    def archive_batch(self, horizon):
+        session = self.session_maker()
+        try:
+            rent_id_list = [row[0] for row in session.query(Rent.id)
+                            .filter(Rent.to_date < horizon)
+                            .order_by(Rent.id)
+                            .limit(self.batch_size)]
+            if not rent_id_list:
+                return 0
+
+            session.execute(ArchivedRent.__table__.insert().from_select(
+                RENT_COLUMNS,
+                select([Rent.__table__.c[column] for column in RENT_COLUMNS]).where(Rent.id.in_(rent_id_list))
+            ))
+            session.execute(archived_rent_operations.insert().from_select(
+                ('client_id', 'rent_id'),
+                select([rent_operations.c.client_id, rent_operations.c.rent_id])
+                .where(rent_operations.c.rent_id.in_(rent_id_list))
+            ))
+            session.execute(rent_operations.delete().where(rent_operations.c.rent_id.in_(rent_id_list)))
+            session.execute(Rent.__table__.delete().where(Rent.id.in_(rent_id_list)))
+            session.commit()
+            return len(rent_id_list)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def run(self):
+        if not self.retention_days:
+            return
+        if self.archive_batch(self.horizon) == self.batch_size:
+            tornado.ioloop.IOLoop.current().add_callback(self.run)
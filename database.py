@@ -53,6 +53,14 @@ class Client(Base):
     )
 
 
+archived_rent_operations = Table(
+    'archived_rent_operations',
+    Base.metadata,
+    Column('client_id', Integer, ForeignKey('clients.id')),
+    Column('rent_id', Integer, ForeignKey('archived_rents.id')),
+)
+
+
 class Rent(Base):
     __tablename__ = 'rents'
 
@@ -61,6 +69,21 @@ class Rent(Base):
     hotel_number = Column(Integer, ForeignKey('hotel_numbers.number'))
     total_price = Column(Float, nullable=False)
 
+    from_date = Column(Date, nullable=False)
+    to_date = Column(Date, nullable=False, index=True)
+
+    # ids of archived rents must never be reused
+    __table_args__ = {'sqlite_autoincrement': True}
+
+
+class ArchivedRent(Base):
+    __tablename__ = 'archived_rents'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    clients = relationship("Client", secondary=archived_rent_operations)
+    hotel_number = Column(Integer, ForeignKey('hotel_numbers.number'))
+    total_price = Column(Float, nullable=False)
+
     from_date = Column(Date, nullable=False)
     to_date = Column(Date, nullable=False)
 
@@ -79,3 +102,19 @@ class User(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String(20), nullable=False)
     password_hash = Column(String(100), nullable=False)
+
+
+class ClientChange(Base):
+    """Log of changed client ids, so every worker can bring its search index up to date."""
+    __tablename__ = 'client_changes'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    client_id = Column(Integer, nullable=False)
+
+    __table_args__ = {'sqlite_autoincrement': True}
+
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
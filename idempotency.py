@@ -0,0 +1,53 @@
+import time
+from collections import OrderedDict, namedtuple
+
+from tornado.concurrent import Future
+
+# fingerprint identifies parameters of the request, the response is replayed only to identical requests
+StoredResponse = namedtuple('StoredResponse', ('status', 'content_type', 'chunks', 'fingerprint'))
+
+
+class IdempotencyStore:
+    """Responses of write requests keyed by their Idempotency-Key.
+
+    While the first request with a key is executed, the key maps to a Future which is resolved with its
+    StoredResponse (or None if the response is not stored), so duplicates can wait for it instead of executing.
+    At most ``max_keys`` finished responses are kept, each for ``ttl`` seconds.
+    """
+
+    def __init__(self, ttl, max_keys=10000, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._clock = clock
+        self._responses = OrderedDict()
+        self._in_flight = {}
+
+    def __len__(self):
+        return len(self._responses)
+
+    def _evict(self, room=0):
+        now = self._clock()
+        while self._responses:
+            key, (expires_at, _) = next(iter(self._responses.items()))
+            if expires_at > now and len(self._responses) + room <= self.max_keys:
+                break
+            del self._responses[key]
+
+    def get(self, key):
+        """Return StoredResponse, Future of request in flight or None if key is unknown."""
+        if key in self._in_flight:
+            return self._in_flight[key]
+        self._evict()
+        entry = self._responses.get(key)
+        return entry[1] if entry else None
+
+    def begin(self, key):
+        self._in_flight[key] = Future()
+
+    def complete(self, key, response):
+        if response is not None:
+            self._evict(room=1)
+            self._responses[key] = (self._clock() + self.ttl, response)
+        future = self._in_flight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(response)
@@ -0,0 +1,168 @@
+from sqlalchemy import func, MetaData, Table, Column, Integer, String, Float, Date, ForeignKey, UniqueConstraint
+
+from database import SchemaVersion
+
+# Tables as each migration created them. They are frozen copies, not the models from database.py:
+# a migration must do the same thing no matter how the models change later.
+baseline_metadata = MetaData()
+
+Table(
+    'first_names',
+    baseline_metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('first_name', String(50), unique=True, nullable=False),
+)
+
+Table(
+    'last_names',
+    baseline_metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('last_name', String(50), unique=True, nullable=False),
+)
+
+Table(
+    'clients',
+    baseline_metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('first_name_id', Integer, ForeignKey('first_names.id')),
+    Column('last_name_id', Integer, ForeignKey('last_names.id')),
+    Column('age', Integer, nullable=False),
+    Column('passport_serial', String(2), nullable=False),
+    Column('passport_number', String(20), nullable=False),
+    UniqueConstraint('passport_serial', 'passport_number', name='passport_info'),
+)
+
+Table(
+    'hotel_numbers',
+    baseline_metadata,
+    Column('number', Integer, primary_key=True),
+    Column('price_per_night', Float, nullable=False),
+    Column('description', String(1000)),
+)
+
+Table(
+    'rents',
+    baseline_metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('hotel_number', Integer, ForeignKey('hotel_numbers.number')),
+    Column('total_price', Float, nullable=False),
+    Column('from_date', Date, nullable=False),
+    Column('to_date', Date, nullable=False),
+)
+
+Table(
+    'rent_operations',
+    baseline_metadata,
+    Column('client_id', Integer, ForeignKey('clients.id')),
+    Column('rent_id', Integer, ForeignKey('rents.id')),
+)
+
+Table(
+    'users',
+    baseline_metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('name', String(20), nullable=False),
+    Column('password_hash', String(100), nullable=False),
+)
+
+archive_metadata = MetaData()
+
+Table(
+    'archived_rents',
+    archive_metadata,
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('hotel_number', Integer, ForeignKey('hotel_numbers.number')),
+    Column('total_price', Float, nullable=False),
+    Column('from_date', Date, nullable=False),
+    Column('to_date', Date, nullable=False),
+)
+
+Table(
+    'archived_rent_operations',
+    archive_metadata,
+    Column('client_id', Integer, ForeignKey('clients.id')),
+    Column('rent_id', Integer, ForeignKey('archived_rents.id')),
+)
+
+# foreign keys of archive tables refer to baseline tables
+Table('hotel_numbers', archive_metadata, Column('number', Integer, primary_key=True))
+Table('clients', archive_metadata, Column('id', Integer, primary_key=True))
+
+client_changes_metadata = MetaData()
+
+Table(
+    'client_changes',
+    client_changes_metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('client_id', Integer, nullable=False),
+    sqlite_autoincrement=True,
+)
+
+
+def create_baseline_tables(connection):
+    # tables are created only if missing, so databases made before versioning are kept as they are
+    baseline_metadata.create_all(connection)
+
+
+def create_archive_tables(connection):
+    archive_metadata.create_all(connection, tables=[archive_metadata.tables['archived_rents'],
+                                                    archive_metadata.tables['archived_rent_operations']])
+
+
+def make_rent_ids_unique(connection):
+    # ids of archived rents must never be given to new rents; other databases never reuse generated ids,
+    # but SQLite does unless the table is declared with AUTOINCREMENT
+    if connection.dialect.name != 'sqlite':
+        return
+
+    connection.execute('DROP INDEX IF EXISTS ix_rents_to_date')
+    connection.execute('''
+        CREATE TABLE rents_autoincrement (
+            id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            hotel_number INTEGER REFERENCES hotel_numbers (number),
+            total_price FLOAT NOT NULL,
+            from_date DATE NOT NULL,
+            to_date DATE NOT NULL
+        )
+    ''')
+    connection.execute('INSERT INTO rents_autoincrement (id, hotel_number, total_price, from_date, to_date) '
+                       'SELECT id, hotel_number, total_price, from_date, to_date FROM rents')
+    connection.execute('DROP TABLE rents')
+    connection.execute('ALTER TABLE rents_autoincrement RENAME TO rents')
+
+    last_id = connection.execute('SELECT MAX(id) FROM (SELECT id FROM rents UNION ALL '
+                                 'SELECT id FROM archived_rents)').scalar() or 0
+    connection.execute("DELETE FROM sqlite_sequence WHERE name IN ('rents', 'rents_autoincrement')")
+    connection.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('rents', ?)", (last_id,))
+
+
+def create_rent_indexes(connection):
+    connection.execute('CREATE INDEX ix_rents_to_date ON rents (to_date)')
+
+
+def create_client_changes_table(connection):
+    client_changes_metadata.create_all(connection)
+
+
+# append only: position in list (starting from 1) is the schema version
+MIGRATIONS = [
+    create_baseline_tables,
+    create_archive_tables,
+    make_rent_ids_unique,
+    create_rent_indexes,
+    create_client_changes_table,
+]
+
+
+def upgrade_schema(engine):
+    """Apply all migrations not applied to the database yet. Returns resulting schema version."""
+    with engine.begin() as connection:
+        SchemaVersion.__table__.create(connection, checkfirst=True)
+        current_version = connection.execute(func.max(SchemaVersion.version).select()).scalar() or 0
+
+        for version, migration in enumerate(MIGRATIONS, start=1):
+            if version > current_version:
+                migration(connection)
+                connection.execute(SchemaVersion.__table__.insert(), version=version)
+
+    return max(current_version, len(MIGRATIONS))
@@ -1,17 +1,19 @@
 import datetime
+import random
 
-from sqlalchemy import create_engine, or_
+from sqlalchemy import create_engine, or_, func
 from sqlalchemy.orm import sessionmaker
 
 from passlib.hash import pbkdf2_sha256
 
-from database import Base, FirstName, LastName, Client, Rent, HotelNumber, User
+from database import Base, FirstName, LastName, Client, Rent, HotelNumber, User, rent_operations
+from migrations import upgrade_schema
 
 
-def insert_sample_data_to_database():
-    engine = create_engine('sqlite:///hotel.db', echo=False)
+def insert_sample_data_to_database(connection_string='sqlite:///hotel.db', clients_count=0, rents_count=0):
+    engine = create_engine(connection_string, echo=False)
     Base.metadata.drop_all(engine)
-    Base.metadata.create_all(engine)
+    upgrade_schema(engine)
 
     # connection = engine.connect()
     Session = sessionmaker(bind=engine)
@@ -63,7 +65,46 @@ def insert_sample_data_to_database():
         User(name='admin', password_hash=pbkdf2_sha256.hash('admin'))
     ])
     session.commit()
+
+    if clients_count or rents_count:
+        insert_generated_data(session, clients_count, rents_count)
     session.close()
+    engine.dispose()
+
+
+def insert_generated_data(session, clients_count, rents_count, seed=0):
+    """Add ``clients_count`` clients and ``rents_count`` rents (of two clients each) with random data."""
+    generator = random.Random(seed)
+    first_name_id_list = [row[0] for row in session.query(FirstName.id)]
+    last_name_id_list = [row[0] for row in session.query(LastName.id)]
+    number_list = [row[0] for row in session.query(HotelNumber.number)]
+    first_client_id = (session.query(func.max(Client.id)).scalar() or 0) + 1
+    first_rent_id = (session.query(func.max(Rent.id)).scalar() or 0) + 1
+
+    if clients_count:
+        session.execute(Client.__table__.insert(), [dict(
+            id=client_id,
+            first_name_id=generator.choice(first_name_id_list),
+            last_name_id=generator.choice(last_name_id_list),
+            age=generator.randint(18, 99),
+            passport_serial='GN',
+            passport_number=str(client_id),
+        ) for client_id in range(first_client_id, first_client_id + clients_count)])
+
+    client_id_list = [row[0] for row in session.query(Client.id)]
+    rents = []
+    operations = []
+    for rent_id in range(first_rent_id, first_rent_id + rents_count):
+        from_date = datetime.date.today() + datetime.timedelta(days=generator.randint(-1000, 100))
+        days = generator.randint(1, 14)
+        rents.append(dict(id=rent_id, hotel_number=generator.choice(number_list), total_price=days * 10.0,
+                          from_date=from_date, to_date=from_date + datetime.timedelta(days=days)))
+        operations += [dict(rent_id=rent_id, client_id=client_id)
+                       for client_id in generator.sample(client_id_list, 2)]
+    if rents:
+        session.execute(Rent.__table__.insert(), rents)
+        session.execute(rent_operations.insert(), operations)
+    session.commit()
 
 
 if __name__ == '__main__':
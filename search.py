@@ -0,0 +1,165 @@
+import bisect
+import heapq
+from collections import defaultdict
+
+from sqlalchemy import func
+
+from database import Client, FirstName, LastName, ClientChange
+
+
+class ClientSearchIndex:
+    """In-memory prefix index over client names and passport data.
+
+    Keys are kept in a few sorted lists (runs) of ``(key, client_id)`` pairs: one run per loaded chunk of clients
+    and the last one for clients added later. A prefix lookup is a binary search in each run followed by a short
+    forward scan, results of the runs are merged. Changes made by other workers are picked up by ``sync``
+    from the client_changes log.
+    """
+
+    # sync keeps only this many latest entries of client_changes; workers that are behind reload the whole index
+    KEPT_CHANGES_COUNT = 10000
+    # clients loaded by one step of ``iter_load``, the IOLoop is blocked for one step only
+    LOAD_CHUNK_SIZE = 10000
+
+    def __init__(self):
+        self._runs = [[]]
+        self._client_keys = defaultdict(set)
+        self._last_change_id = 0
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._client_keys)
+
+    @staticmethod
+    def _normalize(term):
+        return term.strip().casefold()
+
+    @classmethod
+    def _make_keys(cls, first_name, last_name, passport_serial, passport_number):
+        return {cls._normalize(key) for key in (
+            first_name,
+            last_name,
+            passport_number,
+            f'{passport_serial}{passport_number}',
+        ) if key}
+
+    @staticmethod
+    def _query_clients(session):
+        return session.query(Client.id, FirstName.first_name, LastName.last_name,
+                             Client.passport_serial, Client.passport_number) \
+            .join(FirstName) \
+            .join(LastName)
+
+    def iter_load(self, session):
+        """Load the whole index, a chunk of ``LOAD_CHUNK_SIZE`` clients per step of the returned generator.
+
+        The index is replaced when the last step is done; until then it keeps its previous content.
+        """
+        # changes made while loading are applied again by the next sync, which is harmless
+        last_change_id = session.query(func.max(ClientChange.id)).scalar() or 0
+        runs = []
+        client_keys = defaultdict(set)
+        last_client_id = 0
+        while True:
+            rows = self._query_clients(session) \
+                .filter(Client.id > last_client_id) \
+                .order_by(Client.id) \
+                .limit(self.LOAD_CHUNK_SIZE) \
+                .all()
+            if not rows:
+                break
+            run = []
+            for client_id, *fields in rows:
+                keys = self._make_keys(*fields)
+                client_keys[client_id] = keys
+                run.extend((key, client_id) for key in keys)
+            run.sort()
+            runs.append(run)
+            last_client_id = rows[-1][0]
+            yield
+
+        self._runs = runs + [[]]
+        self._client_keys = client_keys
+        self._last_change_id = last_change_id
+        self.loaded = True
+
+    def load(self, session):
+        for _ in self.iter_load(session):
+            pass
+
+    def sync(self, session):
+        """Apply changes of clients logged since the last load or sync."""
+        if not self.loaded:
+            # changes are applied by the load in progress or by the first sync after it
+            return
+        changes = session.query(ClientChange.id, ClientChange.client_id) \
+            .filter(ClientChange.id > self._last_change_id) \
+            .order_by(ClientChange.id) \
+            .all()
+        if not changes:
+            return
+
+        first_kept_change_id = session.query(func.min(ClientChange.id)).scalar()
+        if first_kept_change_id > self._last_change_id + 1:
+            self.load(session)
+            return
+
+        changed_id_set = {client_id for _, client_id in changes}
+        existing_id_set = set()
+        for client_id, *fields in self._query_clients(session).filter(Client.id.in_(changed_id_set)):
+            existing_id_set.add(client_id)
+            self.add(client_id, *fields)
+        for client_id in changed_id_set - existing_id_set:
+            self.remove(client_id)
+        self._last_change_id = changes[-1][0]
+
+        session.query(ClientChange) \
+            .filter(ClientChange.id <= self._last_change_id - self.KEPT_CHANGES_COUNT) \
+            .delete(synchronize_session=False)
+        session.commit()
+
+    def add(self, client_id, first_name, last_name, passport_serial, passport_number):
+        self.remove(client_id)
+        keys = self._make_keys(first_name, last_name, passport_serial, passport_number)
+        self._client_keys[client_id] = keys
+        for key in keys:
+            bisect.insort(self._runs[-1], (key, client_id))
+
+    def remove(self, client_id):
+        for key in self._client_keys.pop(client_id, ()):
+            for run in self._runs:
+                position = bisect.bisect_left(run, (key, client_id))
+                if position < len(run) and run[position] == (key, client_id):
+                    del run[position]
+                    break
+
+    @staticmethod
+    def _iter_run_prefix(run, prefix):
+        position = bisect.bisect_left(run, (prefix,))
+        while position < len(run) and run[position][0].startswith(prefix):
+            yield run[position]
+            position += 1
+
+    def _iter_prefix(self, prefix):
+        for _, client_id in heapq.merge(*(self._iter_run_prefix(run, prefix) for run in self._runs)):
+            yield client_id
+
+    def search(self, query, limit):
+        """Return up to ``limit`` client ids matching every whitespace-separated term of ``query``."""
+        terms = [self._normalize(term) for term in query.split()]
+        if not terms or limit <= 0:
+            return []
+
+        first_term, *other_terms = sorted(terms, key=len, reverse=True)
+        found = []
+        seen = set()
+        for client_id in self._iter_prefix(first_term):
+            if client_id in seen:
+                continue
+            seen.add(client_id)
+            keys = self._client_keys[client_id]
+            if all(any(key.startswith(term) for key in keys) for term in other_terms):
+                found.append(client_id)
+                if len(found) >= limit:
+                    break
+        return found
@@ -0,0 +1,129 @@
+import math
+import time
+from collections import OrderedDict
+from enum import IntEnum
+
+import tornado.ioloop
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = burst
+        self._updated_at = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def consume(self, tokens=1):
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    def retry_after(self, tokens=1):
+        """Seconds until ``tokens`` become available."""
+        self._refill()
+        return max(0.0, (tokens - self._tokens) / self.rate)
+
+
+class RateLimiter:
+    """Set of token buckets keyed by an arbitrary hashable (user, route, ...).
+
+    Only ``max_keys`` most recently used buckets are kept, so unknown clients can not grow it without bound.
+    """
+
+    def __init__(self, rate, burst, max_keys=10000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._clock = clock
+        self._buckets = OrderedDict()
+
+    def _get_bucket(self, key):
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst, clock=self._clock)
+            while len(self._buckets) >= self.max_keys:
+                self._buckets.popitem(last=False)
+        self._buckets[key] = bucket
+        return bucket
+
+    def consume(self, key, tokens=1):
+        """Return 0 if request is allowed, otherwise seconds to wait before retry."""
+        bucket = self._get_bucket(key)
+        if bucket.consume(tokens):
+            return 0
+        return bucket.retry_after(tokens)
+
+
+class Priority(IntEnum):
+    BULK_READ = 0
+    READ = 1
+    WRITE = 2
+
+
+class LoopLagMonitor:
+    """Measures how late the IOLoop runs callbacks, which is how long new requests wait to be read.
+
+    A callback is scheduled every ``interval`` seconds; lag is how late the last one ran or, if the next one is
+    already overdue (loop is blocked right now), how overdue it is.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._io_loop = None
+        self._expected_at = None
+        self._lag = 0.0
+
+    @property
+    def lag(self):
+        if self._io_loop is None:
+            return 0.0
+        return max(self._lag, self._io_loop.time() - self._expected_at)
+
+    def start(self):
+        self._io_loop = tornado.ioloop.IOLoop.current()
+        self._schedule()
+
+    def _schedule(self):
+        self._expected_at = self._io_loop.time() + self.interval
+        self._io_loop.call_at(self._expected_at, self._check)
+
+    def _check(self):
+        self._lag = max(0.0, self._io_loop.time() - self._expected_at)
+        self._schedule()
+
+
+class LoadShedder:
+    """Rejects requests while the IOLoop lags behind for too long.
+
+    Each priority lane tolerates a longer queueing delay than the one below it, so bulk reads are shed
+    first and booking writes last.
+    """
+
+    LANE_DELAY_FACTORS = {
+        Priority.BULK_READ: 1,
+        Priority.READ: 2,
+        Priority.WRITE: 4,
+    }
+
+    def __init__(self, max_queue_delay):
+        self.max_queue_delay = max_queue_delay
+
+    def retry_after(self, priority, loop_lag):
+        """Return 0 if request is admitted, otherwise seconds to wait before retry."""
+        if not self.max_queue_delay:
+            return 0
+        if loop_lag <= self.max_queue_delay * self.LANE_DELAY_FACTORS[priority]:
+            return 0
+        return loop_lag
+
+
+def format_retry_after(seconds):
+    return str(max(1, math.ceil(seconds)))
@@ -25,6 +25,25 @@ def get_last_name_id(session, name):
     return get_last_name_id(session, name)
 
 
+class NameDictionary:
+    """Cache of name -> id for FirstName/LastName, missing names are looked up (or created) in database."""
+
+    def __init__(self, get_name_id, name_column, id_column):
+        self._get_name_id = get_name_id
+        self._name_column = name_column
+        self._id_column = id_column
+        self._ids = {}
+
+    def load(self, session):
+        self._ids = dict(session.query(self._name_column, self._id_column))
+
+    def get_id(self, session, name):
+        name_id = self._ids.get(name)
+        if name_id is None:
+            name_id = self._ids[name] = self._get_name_id(session, name)
+        return name_id
+
+
 def serialize(keys, values_list):
     return json.dumps(
         [{str(k): str(v) if isinstance(v, datetime.date) else v for k, v in zip(keys, row)} for row in values_list]
@@ -1,20 +1,54 @@
+import os
 import string
+import tempfile
+from contextlib import contextmanager
 from http import HTTPStatus
 import logging
 
 import datetime
-import requests
 import json
+import time
 import random
 import unittest
 from typing import List, Dict, Any
-
-from app import DATE_FORMAT
+from urllib.parse import urlencode
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from tornado import gen
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
+
+from app import DATE_FORMAT, Application, BaseHandler, ClientHandler
+from archive import RentArchiver
+from idempotency import IdempotencyStore, StoredResponse
+from migrations import upgrade_schema, MIGRATIONS, baseline_metadata
+from database import Base, Client, ClientChange, Rent, ArchivedRent, HotelNumber
 from sample_data import insert_sample_data_to_database
+from throttling import RateLimiter, LoadShedder, Priority
+
+
+class Response:
+    def __init__(self, response):
+        self.status_code = response.code
+        self.headers = response.headers
+        self.body = response.body
+
+    @property
+    def cookies(self):
+        return '; '.join(cookie.split(';')[0] for cookie in self.headers.get_list('Set-Cookie'))
+
+    def json(self):
+        return json.loads(self.body.decode())
 
 
-class TestHotelAPI(unittest.TestCase):
-    ROOT_URL = 'http://localhost:8888'
+class TestHotelAPI(AsyncHTTPTestCase):
+    """Runs Application in-process against its own temporary copy of sample database."""
+
+    ROOT_URL = ''
+
+    # amount of randomly generated data added to sample data
+    CLIENTS_COUNT = 0
+    RENTS_COUNT = 0
 
     USERNAME = 'admin'
     PASSWORD = 'admin'
@@ -28,6 +62,65 @@ class TestHotelAPI(unittest.TestCase):
         super().__init__(*args, **kwargs)
         self.__auth_cookie = None
 
+    def setUp(self):
+        database_file, self._database_path = tempfile.mkstemp(suffix='.db')
+        os.close(database_file)
+        self._database_connection_string = f'sqlite:///{self._database_path}'
+        insert_sample_data_to_database(self._database_connection_string, self.CLIENTS_COUNT, self.RENTS_COUNT)
+        super().setUp()
+
+    def tearDown(self):
+        self._app.db_session.close()
+        self._app.db_engine.dispose()
+        super().tearDown()
+        os.remove(self._database_path)
+
+    def get_app(self):
+        application = Application(database_connection_string=self._database_connection_string)
+        application.warm_up()
+        self.io_loop.run_sync(application.load_search_index)
+        return application
+
+    def _request(self, method, url, data=None, cookies=None, headers=None):
+        headers = dict(headers or {})
+        if cookies:
+            headers['Cookie'] = cookies
+
+        body = urlencode(data or {}, doseq=True)
+        if method in ('GET', 'DELETE'):
+            if body:
+                url += '?' + body
+            body = None
+        else:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        return Response(self.fetch(url, method=method, body=body, headers=headers))
+
+    def _get(self, url, data=None, **kwargs):
+        return self._request('GET', url, data, **kwargs)
+
+    def _post(self, url, data=None, **kwargs):
+        return self._request('POST', url, data, **kwargs)
+
+    def _put(self, url, data=None, **kwargs):
+        return self._request('PUT', url, data, **kwargs)
+
+    def _delete(self, url, data=None, **kwargs):
+        return self._request('DELETE', url, data, **kwargs)
+
+    @contextmanager
+    def _assert_query_count(self, expected_count, msg=None):
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self._app.db_engine, 'before_cursor_execute', count_statement)
+        try:
+            yield
+        finally:
+            event.remove(self._app.db_engine, 'before_cursor_execute', count_statement)
+        self.assertEqual(len(statements), expected_count, msg=msg or statements)
+
     @property
     def _url(self):
         return self.ROOT_URL
@@ -39,51 +132,91 @@ class TestHotelAPI(unittest.TestCase):
     @property
     def _auth_cookie(self):
         if not self.__auth_cookie:
-            self.__auth_cookie = requests.post(self.ROOT_URL + self.LOGIN_COMMAND,
-                                               dict(username=self.USERNAME, password=self.PASSWORD)).cookies
+            self.__auth_cookie = self._post(self.ROOT_URL + self.LOGIN_COMMAND,
+                                            dict(username=self.USERNAME, password=self.PASSWORD)).cookies
         return self.__auth_cookie
 
 
 class TestHotelLogin(TestHotelAPI):
     def test_login(self):
-        self.assertEqual(requests.post(self._url, dict(username=self.USERNAME, password=self.PASSWORD)).status_code,
+        self.assertEqual(self._post(self._url, dict(username=self.USERNAME, password=self.PASSWORD)).status_code,
                          HTTPStatus.OK)
 
     def test_incorrect_login(self):
-        self.assertEqual(requests.post(self._url, dict(username='wrong user', password='wrong password')).status_code,
+        self.assertEqual(self._post(self._url, dict(username='wrong user', password='wrong password')).status_code,
                          HTTPStatus.UNAUTHORIZED)
 
     def test_without_login(self):
-        self.assertEqual(requests.get(self._url).status_code, HTTPStatus.UNAUTHORIZED)
+        self.assertEqual(self._get(self._url).status_code, HTTPStatus.UNAUTHORIZED)
+
+    def test_login_with_idempotency_key(self):
+        for _ in range(2):
+            response = self._post(self._url, dict(username=self.USERNAME, password=self.PASSWORD),
+                                  headers={'Idempotency-Key': 'key'})
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            self.assertTrue(response.cookies)
+            self.assertIsNone(response.headers.get('Idempotent-Replayed'))
+        self.assertEqual(len(self._app.idempotency_store), 0)
 
     @property
     def _url(self):
         return self.ROOT_URL + self.LOGIN_COMMAND
 
 
+class TestHotelReady(TestHotelAPI):
+    READY_COMMAND = '/ready'
+
+    def test_ready(self):
+        self.assertEqual(self._get(self.ROOT_URL + self.READY_COMMAND).status_code, HTTPStatus.OK)
+
+
+class TestHotelStartup(TestHotelAPI):
+    READY_COMMAND = '/ready'
+    SEARCH_COMMAND = '/client/search'
+
+    def get_app(self):
+        # like a server which listens already, but has not loaded the search index yet
+        application = Application(database_connection_string=self._database_connection_string)
+        application.warm_up()
+        return application
+
+    def test_not_ready_until_search_index_is_loaded(self):
+        search_url = self.ROOT_URL + self.SEARCH_COMMAND
+        self.assertEqual(self._get(self.ROOT_URL + self.READY_COMMAND).status_code, HTTPStatus.SERVICE_UNAVAILABLE)
+        response = self._get(search_url, dict(q='a'), cookies=self._auth_cookie)
+        self.assertEqual(response.status_code, HTTPStatus.SERVICE_UNAVAILABLE)
+        self.assertIn('Retry-After', response.headers)
+
+        self.io_loop.run_sync(self._app.load_search_index)
+        self.assertEqual(self._get(self.ROOT_URL + self.READY_COMMAND).status_code, HTTPStatus.OK)
+        self.assertEqual(self._get(search_url, dict(q='a'), cookies=self._auth_cookie).status_code, HTTPStatus.OK)
+
+    def test_search_index_is_loaded_in_chunks(self):
+        self._app.client_search_index.LOAD_CHUNK_SIZE = 1
+        steps = list(self._app.client_search_index.iter_load(self._app.db_session))
+        self.assertEqual(len(steps), len(self._app.client_search_index))
+        self.assertGreater(len(steps), 1)
+        self.assertTrue(self._app.client_search_index.loaded)
+
+
 class HotelDataAccessTester(TestHotelAPI):
     @classmethod
     def setUpClass(cls):
         if cls is HotelDataAccessTester:
-            insert_sample_data_to_database()
             raise unittest.SkipTest("Skip parent class of tests")
         super().setUpClass()
 
-    def setUp(self):
-        pass
-        # insert_sample_data_to_database()
-
     def test_permission(self):
-        self.assertEqual(requests.get(self._url).status_code, HTTPStatus.UNAUTHORIZED, msg='on GET request')
-        self.assertEqual(requests.post(self._url).status_code, HTTPStatus.FORBIDDEN, msg='on POST request')
-        self.assertEqual(requests.put(self._url).status_code, HTTPStatus.FORBIDDEN, msg='on PUT request')
-        self.assertEqual(requests.delete(self._url).status_code, HTTPStatus.FORBIDDEN, msg='on DELETE request')
+        self.assertEqual(self._get(self._url).status_code, HTTPStatus.UNAUTHORIZED, msg='on GET request')
+        self.assertEqual(self._post(self._url).status_code, HTTPStatus.FORBIDDEN, msg='on POST request')
+        self.assertEqual(self._put(self._url).status_code, HTTPStatus.FORBIDDEN, msg='on PUT request')
+        self.assertEqual(self._delete(self._url).status_code, HTTPStatus.FORBIDDEN, msg='on DELETE request')
 
     def test_bad_request(self):
         for method, method_name in (
-                (requests.post, 'POST'),
-                (requests.put, 'PUT'),
-                (requests.delete, 'DELETE'),
+                (self._post, 'POST'),
+                (self._put, 'PUT'),
+                (self._delete, 'DELETE'),
 
         ):
             self.assertEqual(method(self._url, cookies=self._auth_cookie).status_code, HTTPStatus.BAD_REQUEST,
@@ -96,18 +229,18 @@ class HotelDataAccessTester(TestHotelAPI):
         all_rows = self._get_all()
         row_id = random.choice(self._get_list_of(all_rows, self._col_prefix + self._primary_key))
 
-        response = requests.get(self._url, data={self._primary_key: row_id}, cookies=self._auth_cookie)
+        response = self._get(self._url, data={self._primary_key: row_id}, cookies=self._auth_cookie)
         self.assertEqual(response.status_code, HTTPStatus.OK)
         row = response.json()
         self.assertEqual(row, [row for row in all_rows if row[self._col_prefix + self._primary_key] == row_id])
 
     def test_delete(self):
         row_id = random.choice(self._get_list_of(self._get_all(), f'{self._col_prefix}{self._primary_key}'))
-        requests.delete(self._url, data={self._primary_key: row_id}, cookies=self._auth_cookie)
+        self._delete(self._url, data={self._primary_key: row_id}, cookies=self._auth_cookie)
         self.assertFalse([row for row in self._get_all() if row[f'{self._col_prefix}{self._primary_key}'] == row_id])
 
     def _get_all(self) -> List[Dict[str, Any]]:
-        response = requests.get(self._url, cookies=self._auth_cookie)
+        response = self._get(self._url, cookies=self._auth_cookie)
         self.assertEqual(response.status_code, HTTPStatus.OK)
         return response.json()
 
@@ -126,8 +259,8 @@ class TestHotelClient(HotelDataAccessTester):
             self._get_list_of(self._get_all(), f'{self._col_prefix}passport_number')
         )
         self.assertEqual(
-            requests.post(self._url, self._new_client_parameters(passport_number),
-                          cookies=self._auth_cookie).status_code,
+            self._post(self._url, self._new_client_parameters(passport_number),
+                       cookies=self._auth_cookie).status_code,
             HTTPStatus.OK
         )
 
@@ -140,9 +273,9 @@ class TestHotelClient(HotelDataAccessTester):
                                                                              f'{self._col_prefix}passport_number'))
         new_client = {self._primary_key: row_id, **self._new_client_parameters(passport_number)}
         self.assertEqual(
-            requests.put(self._url,
-                         data=new_client,
-                         cookies=self._auth_cookie).status_code,
+            self._put(self._url,
+                      data=new_client,
+                      cookies=self._auth_cookie).status_code,
             HTTPStatus.OK
         )
 
@@ -177,11 +310,103 @@ class TestHotelClient(HotelDataAccessTester):
         return 'Client.'
 
 
+class TestHotelClientSearch(TestHotelAPI):
+    SEARCH_COMMAND = '/client/search'
+
+    def test_permission(self):
+        self.assertEqual(self._get(self._url, dict(q='a')).status_code, HTTPStatus.UNAUTHORIZED)
+
+    def test_bad_request(self):
+        self.assertEqual(self._get(self._url, cookies=self._auth_cookie).status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_search_by_last_name_prefix(self):
+        client = self._add_client()
+        rows = self._search(client['last_name'][:-2].upper())
+        self.assertIn(client['passport_number'], self._get_list_of(rows, 'Client.passport_number'))
+
+    def test_search_by_passport(self):
+        client = self._add_client()
+        rows = self._search(client['passport_serial'] + client['passport_number'][:5])
+        self.assertIn(client['passport_number'], self._get_list_of(rows, 'Client.passport_number'))
+
+    def test_search_by_several_terms(self):
+        client = self._add_client()
+        rows = self._search(f"{client['first_name']} {client['last_name'][:-1]}")
+        self.assertEqual(self._get_list_of(rows, 'Client.passport_number'), [client['passport_number']])
+
+    def test_limit(self):
+        for _ in range(3):
+            self._add_client(last_name='Limitsearch')
+        self.assertEqual(len(self._search('limitsearch', limit=2)), 2)
+
+    def test_deleted_client_is_not_found(self):
+        client = self._add_client()
+        client_id = self._search(client['passport_number'])[0]['Client.id']
+        self._delete(self.ROOT_URL + self.CLIENT_COMMAND, data=dict(id=client_id), cookies=self._auth_cookie)
+        self.assertEqual(self._search(client['passport_number']), [])
+
+    def test_changes_of_other_worker(self):
+        session = self._app.db_session_maker()
+        client = Client(first_name_id=1, last_name_id=1, age=30, passport_serial='OW', passport_number='777')
+        session.add(client)
+        session.flush()
+        session.add(ClientChange(client_id=client.id))
+        session.query(Client).filter(Client.id == 1).delete()
+        session.add(ClientChange(client_id=1))
+        session.commit()
+        client_id = client.id
+        session.close()
+
+        self.assertEqual(self._search('ow777'), [])
+        self._app.sync_client_search_index()
+        self.assertEqual(self._get_list_of(self._search('ow777'), 'Client.id'), [client_id])
+        self.assertNotIn(1, self._app.client_search_index.search('ivan', 10))
+
+    def test_change_of_unknown_client_is_not_indexed(self):
+        client = dict(self._new_client_parameters(), id=999999)
+        self._put(self.ROOT_URL + self.CLIENT_COMMAND, client, cookies=self._auth_cookie)
+        self.assertEqual(len(self._app.client_search_index), 4)
+        self.assertEqual(self._search(client['passport_number']), [])
+
+    def test_not_numeric_id(self):
+        for method in (self._put, self._delete):
+            self.assertEqual(method(self.ROOT_URL + self.CLIENT_COMMAND, dict(self._new_client_parameters(), id='x'),
+                                    cookies=self._auth_cookie).status_code, HTTPStatus.BAD_REQUEST)
+
+    @staticmethod
+    def _new_client_parameters():
+        return dict(first_name='Unknown', last_name='Unknown', age=30, passport_serial='UN',
+                    passport_number=''.join(str(random.randint(0, 9)) for _ in range(12)))
+
+    def _add_client(self, last_name=None):
+        client = dict(
+            first_name='Search' + ''.join(random.choice(string.ascii_lowercase) for _ in range(8)),
+            last_name=last_name or 'Search' + ''.join(random.choice(string.ascii_lowercase) for _ in range(8)),
+            age=random.randint(18, 99),
+            passport_serial=''.join(random.choice(string.ascii_uppercase) for _ in range(2)),
+            passport_number=''.join(str(random.randint(0, 9)) for _ in range(12)),
+        )
+        self._post(self.ROOT_URL + self.CLIENT_COMMAND, client, cookies=self._auth_cookie)
+        return client
+
+    def _search(self, search_query, limit=None) -> List[Dict[str, Any]]:
+        parameters = dict(q=search_query)
+        if limit:
+            parameters['limit'] = limit
+        response = self._get(self._url, parameters, cookies=self._auth_cookie)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        return response.json()
+
+    @property
+    def _url(self):
+        return self.ROOT_URL + self.SEARCH_COMMAND
+
+
 class TestHotelRent(HotelDataAccessTester):
     def test_add(self):
         new_rent = self._new_rent()
         self.assertEqual(
-            requests.post(self._url, new_rent, cookies=self._auth_cookie).status_code,
+            self._post(self._url, new_rent, cookies=self._auth_cookie).status_code,
             HTTPStatus.OK
         )
 
@@ -191,12 +416,42 @@ class TestHotelRent(HotelDataAccessTester):
         rent_id = random.choice(self._get_all())[self._col_prefix + self._primary_key]
         new_rent = self._new_rent()
         self.assertEqual(
-            requests.put(self._url, {self._primary_key: rent_id, **new_rent}, cookies=self._auth_cookie).status_code,
+            self._put(self._url, {self._primary_key: rent_id, **new_rent}, cookies=self._auth_cookie).status_code,
             HTTPStatus.OK
         )
 
         self._check_exists(new_rent)
 
+    def test_add_with_idempotency_key(self):
+        new_rent = self._new_rent()
+        headers = {'Idempotency-Key': ''.join(random.choice(string.ascii_letters) for _ in range(20))}
+        first_response = self._post(self._url, new_rent, headers=headers, cookies=self._auth_cookie)
+        second_response = self._post(self._url, new_rent, headers=headers, cookies=self._auth_cookie)
+
+        self.assertEqual(first_response.status_code, HTTPStatus.OK)
+        self.assertEqual(second_response.status_code, HTTPStatus.OK)
+        self.assertEqual(second_response.headers.get('Idempotent-Replayed'), 'true')
+        self._check_exists(new_rent)
+
+    def test_idempotency_key_with_other_parameters(self):
+        headers = {'Idempotency-Key': 'key'}
+        first_rent = self._new_rent()
+        second_rent = dict(first_rent, to_date=first_rent['to_date'] + datetime.timedelta(days=1))
+        self.assertEqual(self._post(self._url, first_rent, headers=headers, cookies=self._auth_cookie).status_code,
+                         HTTPStatus.OK)
+
+        response = self._post(self._url, second_rent, headers=headers, cookies=self._auth_cookie)
+        self.assertEqual(response.status_code, HTTPStatus.UNPROCESSABLE_ENTITY)
+        self.assertIsNone(response.headers.get('Idempotent-Replayed'))
+        self.assertFalse([row for row in self._get_all()
+                          if row[f'{self._col_prefix}to_date'] == str(second_rent['to_date'])
+                          and row[f'{self._col_prefix}from_date'] == str(second_rent['from_date'])])
+
+    def test_get_with_history(self):
+        response = self._get(self._url, dict(history=1), cookies=self._auth_cookie)
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertGreaterEqual(len(response.json()), len(self._get_all()))
+
     def _check_exists(self, rent, rent_id=None):
         all_rows = self._get_all()
         self.assertEqual(len([row for row in all_rows
@@ -209,8 +464,8 @@ class TestHotelRent(HotelDataAccessTester):
         today = datetime.date.today()
         from_date = today + datetime.timedelta(days=random.randrange(10))
         to_date = from_date + datetime.timedelta(days=random.randrange(10))
-        all_clients_row = requests.get(self.ROOT_URL + self.CLIENT_COMMAND, cookies=self._auth_cookie).json()
-        all_numbers_row = requests.get(self.ROOT_URL + self.NUMBER_COMMAND, cookies=self._auth_cookie).json()
+        all_clients_row = self._get(self.ROOT_URL + self.CLIENT_COMMAND, cookies=self._auth_cookie).json()
+        all_numbers_row = self._get(self.ROOT_URL + self.NUMBER_COMMAND, cookies=self._auth_cookie).json()
         number = random.choice(self._get_list_of(all_numbers_row, f'HotelNumber.number'))
         random.shuffle(all_clients_row)
         client_id_list = [
@@ -232,20 +487,20 @@ class TestHotelNumber(HotelDataAccessTester):
     def test_get_filters(self):
         current_rented = self._make_new_number()
         future_rented = self._make_new_number()
-        requests.post(self._url, data=current_rented, cookies=self._auth_cookie)
-        requests.post(self._url, data=future_rented, cookies=self._auth_cookie)
+        self._post(self._url, data=current_rented, cookies=self._auth_cookie)
+        self._post(self._url, data=future_rented, cookies=self._auth_cookie)
 
-        clients_id = [row['Client.id'] for row in requests.get(self.ROOT_URL + self.CLIENT_COMMAND,
-                                                               cookies=self._auth_cookie).json()[:2]]
+        clients_id = [row['Client.id'] for row in self._get(self.ROOT_URL + self.CLIENT_COMMAND,
+                                                            cookies=self._auth_cookie).json()[:2]]
 
-        requests.post(self.ROOT_URL + self.RENT_COMMAND, dict(
+        self._post(self.ROOT_URL + self.RENT_COMMAND, dict(
             hotel_number=current_rented[self._primary_key],
             from_date=(datetime.datetime.now() + datetime.timedelta(days=-2)).date(),
             to_date=(datetime.datetime.now() + datetime.timedelta(days=2)).date(),
             client_id=clients_id
         ), cookies=self._auth_cookie)
 
-        requests.post(self.ROOT_URL + self.RENT_COMMAND, dict(
+        self._post(self.ROOT_URL + self.RENT_COMMAND, dict(
             hotel_number=future_rented[self._primary_key],
             from_date=(datetime.datetime.now() + datetime.timedelta(days=2)).date(),
             to_date=(datetime.datetime.now() + datetime.timedelta(days=4)).date(),
@@ -267,13 +522,39 @@ class TestHotelNumber(HotelDataAccessTester):
             if date:
                 parameters['date'] = date
 
-            self.assertEqual(len([row for row in requests.get(self._url, parameters, cookies=self._auth_cookie).json()
+            self.assertEqual(len([row for row in self._get(self._url, parameters, cookies=self._auth_cookie).json()
                                   if row[self._col_prefix + self._primary_key] == hotel_number[self._primary_key]]),
                              excepted_list_length)
 
+    def test_free_after_archivation(self):
+        free_numbers = self._get_free_numbers()
+        archiver = self._app.rent_archiver
+        self.assertGreater(archiver.archive_batch(archiver.horizon), 0)
+
+        self.assertEqual(self._get_free_numbers(), free_numbers)
+        self.assertEqual(self._get_free_numbers(history=1), free_numbers)
+        self.assertEqual(self._get_free_numbers(date='2017-10-10', history=1), [1, 3])
+
+    def test_changes_of_other_worker(self):
+        session = self._app.db_session_maker()
+        session.add(HotelNumber(number=9999, price_per_night=100))
+        session.commit()
+        session.close()
+
+        all_numbers = self._get_list_of(self._get_all(), self._col_prefix + self._primary_key)
+        self.assertNotIn(9999, all_numbers)
+        self._app.hotel_numbers_expire_at = time.monotonic()
+        all_numbers = self._get_list_of(self._get_all(), self._col_prefix + self._primary_key)
+        self.assertIn(9999, all_numbers)
+
+    def _get_free_numbers(self, **parameters):
+        return sorted(self._get_list_of(self._get(self._url, dict(state='free', **parameters),
+                                                  cookies=self._auth_cookie).json(),
+                                        self._col_prefix + self._primary_key))
+
     def test_add(self):
         new_number = self._make_new_number()
-        self.assertEqual(requests.post(self._url, data=new_number, cookies=self._auth_cookie).status_code,
+        self.assertEqual(self._post(self._url, data=new_number, cookies=self._auth_cookie).status_code,
                          HTTPStatus.OK)
 
         self.assertTrue(new_number[self._primary_key] in
@@ -283,7 +564,7 @@ class TestHotelNumber(HotelDataAccessTester):
         new_number = self._make_new_number(random.choice(self._get_list_of(self._get_all(),
                                                                            self._col_prefix + self._primary_key)))
 
-        self.assertEqual(requests.put(self._url, new_number, cookies=self._auth_cookie).status_code,
+        self.assertEqual(self._put(self._url, new_number, cookies=self._auth_cookie).status_code,
                          HTTPStatus.OK)
 
         self.assertEqual(len([row for row in self._get_all() if
@@ -313,6 +594,307 @@ class TestHotelNumber(HotelDataAccessTester):
         return 'number'
 
 
+class TestHotelQueryCount(TestHotelAPI):
+    """Number of SQL statements per request must not depend on amount of data."""
+
+    CLIENTS_COUNT = 1000
+    RENTS_COUNT = 1000
+
+    def test_read(self):
+        for url, parameters, expected_count in (
+                (self.CLIENT_COMMAND, None, 1),
+                (self.CLIENT_COMMAND, dict(id=1), 1),
+                (TestHotelClientSearch.SEARCH_COMMAND, dict(q='iv'), 1),
+                (self.RENT_COMMAND, None, 1),
+                (self.RENT_COMMAND, dict(history=1), 2),
+                (self.NUMBER_COMMAND, None, 0),
+                (self.NUMBER_COMMAND, dict(state='free'), 1),
+                (self.NUMBER_COMMAND, dict(state='rented'), 1),
+                (self.NUMBER_COMMAND, dict(state='rented', history=1), 2),
+        ):
+            cookies = self._auth_cookie
+            with self._assert_query_count(expected_count, msg=f'GET {url} {parameters}'):
+                self.assertEqual(self._get(url, parameters, cookies=cookies).status_code, HTTPStatus.OK)
+
+    def test_write(self):
+        client = dict(first_name='Ivan', last_name='Petrov', age=20, passport_serial='XX')
+        rent = dict(hotel_number=1, from_date='2030-01-01', to_date='2030-01-03', client_id=[1, 2])
+        for method, url, parameters, expected_count in (
+                (self._post, self.CLIENT_COMMAND, dict(client, passport_number='1'), 3),
+                (self._put, self.CLIENT_COMMAND, dict(client, id=1, passport_number='2'), 2),
+                (self._post, self.RENT_COMMAND, rent, 4),
+                (self._put, self.RENT_COMMAND, dict(rent, id=1), 7),
+                (self._post, self.NUMBER_COMMAND, dict(number=50, price_per_night=1, description='New'), 1),
+        ):
+            cookies = self._auth_cookie
+            with self._assert_query_count(expected_count, msg=f'{method.__name__} {url}'):
+                self.assertEqual(method(url, parameters, cookies=cookies).status_code, HTTPStatus.OK)
+
+    def test_idempotent_replay(self):
+        cookies = self._auth_cookie
+        headers = {'Idempotency-Key': 'key'}
+        self._post(self.NUMBER_COMMAND, dict(number=50, price_per_night=1, description='New'),
+                   cookies=cookies, headers=headers)
+        with self._assert_query_count(0):
+            self._post(self.NUMBER_COMMAND, dict(number=50, price_per_night=1, description='New'),
+                       cookies=cookies, headers=headers)
+
+
+class TestHotelThrottling(TestHotelAPI):
+    def test_route_rate_limit(self):
+        cookies = self._auth_cookie
+        self._app.route_rate_limiters[ClientHandler] = RateLimiter(rate=0.1, burst=2)
+
+        self.assertEqual([self._get(self.CLIENT_COMMAND, cookies=cookies).status_code for _ in range(2)],
+                         [HTTPStatus.OK, HTTPStatus.OK])
+        response = self._get(self.CLIENT_COMMAND, cookies=cookies)
+        self.assertEqual(response.status_code, HTTPStatus.TOO_MANY_REQUESTS)
+        self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+        self.assertEqual(self._get(self.RENT_COMMAND, cookies=cookies).status_code, HTTPStatus.OK)
+
+    def test_user_rate_limit(self):
+        cookies = self._auth_cookie
+        self._app.user_rate_limiter = RateLimiter(rate=0.1, burst=2)
+
+        self.assertEqual(self._get(self.CLIENT_COMMAND, cookies=cookies).status_code, HTTPStatus.OK)
+        self.assertEqual(self._get(self.RENT_COMMAND, cookies=cookies).status_code, HTTPStatus.OK)
+        response = self._get(self.NUMBER_COMMAND, cookies=cookies)
+        self.assertEqual(response.status_code, HTTPStatus.TOO_MANY_REQUESTS)
+        self.assertIn('Retry-After', response.headers)
+
+    @gen_test
+    def test_load_shedding(self):
+        self._app.load_shedder = LoadShedder(max_queue_delay=0.2)
+        self._app.loop_lag_monitor.start()
+        yield gen.sleep(0.2)
+
+        # a synchronous handler blocks the loop while requests are waiting
+        self.io_loop.add_callback(time.sleep, 0.5)
+        bulk_read, read, write = yield [
+            self.http_client.fetch(self.get_url(self.NUMBER_COMMAND), raise_error=False),
+            self.http_client.fetch(self.get_url(self.NUMBER_COMMAND + '?number=1'), raise_error=False),
+            self.http_client.fetch(self.get_url(self.NUMBER_COMMAND), method='POST', body='', raise_error=False),
+        ]
+
+        self.assertEqual(bulk_read.code, HTTPStatus.SERVICE_UNAVAILABLE)
+        self.assertIn('Retry-After', bulk_read.headers)
+        self.assertEqual(read.code, HTTPStatus.SERVICE_UNAVAILABLE)
+        # writes tolerate 4 * 0.2 seconds of lag, so this one is admitted (and rejected as not logged in)
+        self.assertEqual(write.code, HTTPStatus.FORBIDDEN)
+
+        yield gen.sleep(0.3)
+        response = yield self.http_client.fetch(self.get_url(self.NUMBER_COMMAND), raise_error=False,
+                                                follow_redirects=False)
+        self.assertEqual(response.code, HTTPStatus.FOUND)
+
+
+class SlowWriteHandler(BaseHandler):
+    """Asynchronous write, the built-in handlers are synchronous and never run concurrently."""
+
+    IDEMPOTENT = True
+    calls_count = 0
+
+    @gen.coroutine
+    def post(self):
+        SlowWriteHandler.calls_count += 1
+        yield gen.sleep(0.1)
+        self.write(f'call {SlowWriteHandler.calls_count}')
+
+
+class TestHotelIdempotency(TestHotelAPI):
+    SLOW_WRITE_COMMAND = '/slow_write'
+
+    def get_app(self):
+        application = super().get_app()
+        application.add_handlers('.*$', [(self.SLOW_WRITE_COMMAND, SlowWriteHandler)])
+        return application
+
+    def setUp(self):
+        super().setUp()
+        SlowWriteHandler.calls_count = 0
+
+    @gen_test
+    def test_duplicate_waits_for_request_in_flight(self):
+        headers = {'Idempotency-Key': 'key'}
+        first, second = yield [
+            self.http_client.fetch(self.get_url(self.SLOW_WRITE_COMMAND), method='POST', body='', headers=headers),
+            self.http_client.fetch(self.get_url(self.SLOW_WRITE_COMMAND), method='POST', body='', headers=headers),
+        ]
+
+        self.assertEqual(SlowWriteHandler.calls_count, 1)
+        self.assertEqual(first.body, b'call 1')
+        self.assertEqual(second.body, b'call 1')
+        self.assertIsNone(first.headers.get('Idempotent-Replayed'))
+        self.assertEqual(second.headers.get('Idempotent-Replayed'), 'true')
+
+
+class TestMigrations(unittest.TestCase):
+    def test_upgrade_is_idempotent(self):
+        engine = create_engine('sqlite://')
+        self.assertEqual(upgrade_schema(engine), len(MIGRATIONS))
+        self.assertEqual(upgrade_schema(engine), len(MIGRATIONS))
+        self.assertEqual(engine.execute('SELECT COUNT(*) FROM schema_version').scalar(), len(MIGRATIONS))
+
+    def test_upgrade_unversioned_database(self):
+        engine = self._make_unversioned_database()
+
+        upgrade_schema(engine)
+        self.assertIn('ix_rents_to_date', [row[0] for row in engine.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")])
+        self.assertTrue(engine.has_table(ArchivedRent.__tablename__))
+        self.assertEqual(engine.execute('SELECT COUNT(*) FROM rents').scalar(), 3)
+
+    def test_archived_rent_ids_are_not_reused(self):
+        engine = self._make_unversioned_database()
+        upgrade_schema(engine)
+        session_maker = sessionmaker(bind=engine)
+        archiver = RentArchiver(session_maker, retention_days=30, batch_size=10)
+        self.assertEqual(archiver.archive_batch(archiver.horizon), 3)
+
+        session = session_maker()
+        rent = Rent(hotel_number=1, total_price=10, from_date=datetime.date(2017, 2, 1),
+                    to_date=datetime.date(2017, 2, 2))
+        session.add(rent)
+        session.commit()
+        self.assertEqual(rent.id, 4)
+        self.assertEqual(archiver.archive_batch(archiver.horizon), 1)
+
+    @staticmethod
+    def _make_unversioned_database():
+        engine = create_engine('sqlite://')
+        baseline_metadata.create_all(engine)
+        engine.execute("INSERT INTO hotel_numbers (number, price_per_night) VALUES (1, 10)")
+        for rent_id in range(1, 4):
+            engine.execute("INSERT INTO rents (id, hotel_number, total_price, from_date, to_date) "
+                           "VALUES (?, 1, 10, '2017-01-01', '2017-01-02')", (rent_id,))
+        return engine
+
+
+class TestRentArchiver(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session_maker = sessionmaker(bind=engine)
+        self.session = self.session_maker()
+
+        client = Client(first_name_id=1, last_name_id=1, age=18, passport_serial='FB', passport_number='1')
+        self.session.add_all([
+            HotelNumber(number=1, price_per_night=10.0),
+            *[Rent(hotel_number=1, total_price=10, from_date=datetime.date(2017, 1, day),
+                   to_date=datetime.date(2017, 1, day + 1), clients=[client]) for day in range(1, 6)],
+            Rent(hotel_number=1, total_price=10, from_date=datetime.date.today(),
+                 to_date=datetime.date.today() + datetime.timedelta(days=1), clients=[client]),
+        ])
+        self.session.commit()
+
+    def test_archive_batch(self):
+        archiver = RentArchiver(self.session_maker, retention_days=30, batch_size=2)
+        self.assertEqual(archiver.archive_batch(archiver.horizon), 2)
+        self.assertEqual(self.session.query(Rent).count(), 4)
+        self.assertEqual(self.session.query(ArchivedRent).count(), 2)
+
+    def test_archive_all(self):
+        archiver = RentArchiver(self.session_maker, retention_days=30, batch_size=2)
+        while archiver.archive_batch(archiver.horizon):
+            pass
+
+        self.assertEqual([rent.from_date for rent in self.session.query(Rent)], [datetime.date.today()])
+        archived_rents = self.session.query(ArchivedRent).order_by(ArchivedRent.id).all()
+        self.assertEqual([rent.id for rent in archived_rents], [1, 2, 3, 4, 5])
+        self.assertTrue(all(rent.clients for rent in archived_rents))
+
+
+class TestIdempotencyStore(AsyncTestCase):
+    RESPONSE = StoredResponse(HTTPStatus.OK, 'application/json', ['[]'], 'fingerprint')
+
+    def setUp(self):
+        super().setUp()
+        self.clock = FakeClock()
+        self.store = IdempotencyStore(ttl=10, max_keys=2, clock=self.clock)
+
+    def test_unknown_key(self):
+        self.assertIsNone(self.store.get('key'))
+
+    def test_in_flight(self):
+        self.store.begin('key')
+        future = self.store.get('key')
+        self.assertFalse(future.done())
+
+        self.store.complete('key', self.RESPONSE)
+        self.assertEqual(future.result(), self.RESPONSE)
+        self.assertEqual(self.store.get('key'), self.RESPONSE)
+
+    def test_failed_response_is_not_kept(self):
+        self.store.begin('key')
+        future = self.store.get('key')
+        self.store.complete('key', None)
+        self.assertIsNone(future.result())
+        self.assertIsNone(self.store.get('key'))
+
+    def test_ttl(self):
+        self.store.begin('key')
+        self.store.complete('key', self.RESPONSE)
+        self.clock.now += 11
+        self.assertIsNone(self.store.get('key'))
+
+    def test_max_keys(self):
+        for key in ('first', 'second', 'third'):
+            self.store.begin(key)
+            self.store.complete(key, self.RESPONSE)
+        self.assertIsNone(self.store.get('first'))
+        self.assertEqual(self.store.get('third'), self.RESPONSE)
+        self.assertEqual(len(self.store), 2)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.rate_limiter = RateLimiter(rate=2, burst=3, max_keys=2, clock=self.clock)
+
+    def test_burst(self):
+        self.assertEqual([self.rate_limiter.consume('user') for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(self.rate_limiter.consume('user'), 0.5)
+
+    def test_refill(self):
+        for _ in range(3):
+            self.rate_limiter.consume('user')
+        self.clock.now += 0.5
+        self.assertEqual(self.rate_limiter.consume('user'), 0)
+        self.assertGreater(self.rate_limiter.consume('user'), 0)
+
+    def test_keys_are_independent(self):
+        for _ in range(3):
+            self.rate_limiter.consume('user')
+        self.assertEqual(self.rate_limiter.consume('other user'), 0)
+
+    def test_least_recently_used_key_is_evicted(self):
+        for _ in range(3):
+            self.rate_limiter.consume('user')
+        self.rate_limiter.consume('second user')
+        self.rate_limiter.consume('third user')
+        self.assertEqual(self.rate_limiter.consume('user'), 0)
+
+
+class TestLoadShedder(unittest.TestCase):
+    def test_lanes(self):
+        load_shedder = LoadShedder(max_queue_delay=0.1)
+        self.assertEqual(load_shedder.retry_after(Priority.BULK_READ, 0.05), 0)
+        self.assertGreater(load_shedder.retry_after(Priority.BULK_READ, 0.15), 0)
+        self.assertEqual(load_shedder.retry_after(Priority.READ, 0.15), 0)
+        self.assertGreater(load_shedder.retry_after(Priority.READ, 0.3), 0)
+        self.assertEqual(load_shedder.retry_after(Priority.WRITE, 0.3), 0)
+
+    def test_disabled(self):
+        self.assertEqual(LoadShedder(max_queue_delay=0).retry_after(Priority.BULK_READ, 100), 0)
+
+
 if __name__ == '__main__':
-    insert_sample_data_to_database()
     unittest.main()